@@ -1,10 +1,13 @@
 """Script to summarize memory prices."""
 
+import ast
 import collections
 import datetime
 import decimal
+import functools
 import json
-import statistics
+import operator
+import re
 import unittest
 
 LABELS = (
@@ -17,7 +20,35 @@ LABELS = (
 )
 """Tuple of string labels found in the YAML price data with proper indent."""
 
+_ZERO = decimal.Decimal()
+"""decimal.Decimal zero price shared by descriptions that fail to parse."""
+
+_DESCRIPTION_RE = re.compile(
+    r'(?:(\d+)x)?(\d+)GB@\$(\d[\d,]*(?:\.\d+)?)(?: (.*))?')
+"""Compiled regular expression matching a description like 2x8GB@$19.99 Foo."""
+
+_MICRO_CENTER_DIV = '<div id="productImpressions" class="hidden">'
+"""String opening tag of the div holding the micro center products."""
+
+_STRING_RE = re.compile(
+    r"'[^'\\]*(?:\\.[^'\\]*)*'" r'|"[^"\\]*(?:\\.[^"\\]*)*"')
+"""Compiled regular expression matching a single or double quoted string."""
+
+_NEWEGG_RE = re.compile(
+    r'<title>\s*&#36;\s*(\d[\d,]*(?:\.\d+)?) - ([^\s<]+)([^<]*)</title>',
+    re.ASCII)
+"""Compiled regular expression matching the price and brand in a title."""
+
+_PRICE_RE = re.compile(r'\d[\d,]*(?:\.\d+)?')
+"""Compiled regular expression matching a price with optional commas."""
+
+_SIZE_RE = re.compile(r'(\d+)\s*GB', re.ASCII)
+"""Compiled regular expression matching a size in GB."""
+
 class Item:
+    __slots__ = ('date', 'dimm_type', 'store', 'count', 'size', 'price',
+                 'brand')
+
     def __init__(self, date, dimm_type, store, count, size, price, brand):
         """Initialize an Item instance."""
         if not isinstance(date, datetime.date):
@@ -66,6 +97,23 @@ class Item:
         self.brand = brand.strip().lower()
         """String brand of the manufacturer."""
 
+    @classmethod
+    def _unchecked(cls, date, dimm_type, store, count, size, price, brand):
+        """Return an Item instance without validating the arguments.
+
+        Only for callers, like _parse_document, that have already validated
+        the arguments.
+        """
+        item = cls.__new__(cls)
+        item.date = date
+        item.dimm_type = dimm_type.strip().lower()
+        item.store = store.strip().lower()
+        item.count = count
+        item.size = size
+        item.price = price
+        item.brand = brand.strip().lower()
+        return item
+
     def __str__(self):
         return '{}x{}GB@${} {} for {} from {} on {}'.format(
             self.count, self.size, self.price, self.brand,
@@ -77,6 +125,43 @@ class Item:
         return self.count * self.size
 
 
+@functools.lru_cache(maxsize=4096)
+def _to_decimal(price):
+    """Return a decimal.Decimal parsed from the string price.
+
+    Prices repeat often within a page, so the results are cached.
+
+    Args:
+        price: String price that may contain thousands separators.
+    Returns:
+        decimal.Decimal price.
+    """
+    return decimal.Decimal(price.replace(',', ''))
+
+@functools.lru_cache(maxsize=8192)
+def _parse_valid_description(description):
+    """Return the count, the size, the price, and the brand from description.
+
+    Args:
+        description: String description already checked by _parse_description.
+    Returns:
+        Tuple of the values returned by _parse_description.
+    """
+    match = _DESCRIPTION_RE.fullmatch(description)
+    if match is None:
+        return 1, 0, _ZERO, ''
+
+    count, size, price, brand = match.groups()
+    if count is None:
+        count = 1
+    else:
+        count = int(count)
+    if brand is None:
+        # A description without a brand is incomplete
+        return count, 0, _ZERO, ''
+
+    return count, int(size), _to_decimal(price), brand
+
 def _parse_description(description):
     """Return the count, the size, the price, and the brand from description.
 
@@ -93,26 +178,9 @@ def _parse_description(description):
     if len(description) < 10:
         raise ValueError('description must be a non-empty string.')
 
-    x_index = description.find('x')
-    dollar_index = description.find('GB@$')
-    space_index = description.find(' ')
-
-    if x_index <= 0:
-        count = 1
-    else:
-        count = int(description[:x_index])
-
-    size = 0
-    price = decimal.Decimal()
-    brand = ''
-    if space_index > 0:
-        brand = description[space_index+1:]
-        if dollar_index > 0:
-            size = int(description[x_index+1:dollar_index])
-            price = decimal.Decimal(description[dollar_index+4:space_index])
-
-    return count, size, price, brand
+    return _parse_valid_description(description)
 
+@functools.lru_cache(maxsize=2048)
 def _parse_module_size(description):
     """Return a string size of the memory module in description.
 
@@ -133,24 +201,7 @@ def _parse_module_size(description):
     if not isinstance(description, str):
         raise TypeError('description must be a string.')
 
-    sizes = []
-    end = -1
-    while True:
-        end = description.find('GB', end + 1)
-        if end <= 0:
-            break
-        start = end - 1
-        # Skip any space between the size and "GB"
-        while (start >= 0) and description[start].isspace():
-            start -= 1
-        # Move to the start of the size
-        while (start >= 0) and description[start].isdigit():
-            start -= 1
-        start += 1
-        try:
-            sizes.append(int(description[start:end].strip()))
-        except ValueError:
-            pass
+    sizes = [int(size) for size in _SIZE_RE.findall(description)]
 
     if len(sizes) <= 0:
         return None
@@ -164,6 +215,25 @@ def _parse_module_size(description):
             denominator = min(*sizes[:2])
             return '{}x{}'.format(numerator // denominator, denominator)
 
+def _to_json_string(match):
+    """Return the quoted string in match as a JSON string.
+
+    Args:
+        match: re.Match of _STRING_RE for a Python string literal.
+    Returns:
+        String JSON string with the same value.
+    """
+    literal = match.group(0)
+    if literal.startswith('"'):
+        if '\\' not in literal:
+            return literal
+    elif '"' not in literal:
+        body = literal[1:-1].replace("\\'", "'")
+        if '\\' not in body:
+            return '"' + body + '"'
+    # Decode any other escapes with the Python parser
+    return json.dumps(ast.literal_eval(literal))
+
 def _parse_micro_center(source):
     """Parse and print the micro center webpage in source.
 
@@ -175,27 +245,48 @@ def _parse_micro_center(source):
     if not isinstance(source, str):
         raise TypeError('source must be a string.')
 
-    start = source.find('<div id="productImpressions" class="hidden">')
-    end = source.find('</div>', start + 44)
-    products = json.loads('[' + source[start+44:end].replace("'", '"') + ']')
+    start = source.find(_MICRO_CENTER_DIV)
+    if start < 0:
+        return []
+    start += len(_MICRO_CENTER_DIV)
+    end = source.find('</div>', start)
+    if end < 0:
+        return []
+
+    payload = source[start:end]
+    if ('"' in payload) or ('\\' in payload):
+        # Only convert the strings that are not already valid JSON
+        payload = _STRING_RE.sub(_to_json_string, payload)
+    else:
+        payload = payload.replace("'", '"')
+    products = json.loads('[' + payload + ']')
     if not isinstance(products, list):
         return []
 
     descriptions = []
+    # Bind the functions called per item to locals for faster lookups
+    append = descriptions.append
+    parse_module_size = _parse_module_size
+    to_decimal = _to_decimal
     for product in products:
         if not isinstance(product, dict):
             continue
-        size = _parse_module_size(product.get('name'))
+        name = product.get('name')
+        price = product.get('price')
+        if not (isinstance(name, str) and isinstance(price, str) and
+                _PRICE_RE.fullmatch(price)):
+            continue
+        size = parse_module_size(name)
         if not isinstance(size, str):
             continue
-        price = product.get('price')
         size += 'GB@${} {}'.format(price, product.get('brand'))
         # Add price as the first element of the tuple for sorting
-        descriptions.append((decimal.Decimal(price.replace(',', '')), size))
+        append((to_decimal(price), size))
 
     if len(descriptions) > 0:
         print('        micro center:')
-        descriptions.sort()
+        # Sort by price only, keeping the page order for equal prices
+        descriptions.sort(key=operator.itemgetter(0))
         for price, description in descriptions:
             print('        -', description)
 
@@ -213,70 +304,82 @@ def _parse_newegg(source):
         raise TypeError('source must be a string.')
 
     descriptions = []
-    start = -1
-    while True:
-        start = source.find('<title>', start + 1)
-        if start <= 0:
-            break
-        end = source.find('</title>', start + 7)
-        title = source[start+7:end].strip()
-        if not title.startswith('&#36;'):
-            continue
-
-        title = title[5:]
-        size = _parse_module_size(title)
+    append = descriptions.append
+    parse_module_size = _parse_module_size
+    to_decimal = _to_decimal
+    for match in _NEWEGG_RE.finditer(source):
+        price, brand, rest = match.groups()
+        size = parse_module_size(brand + rest)
         if not isinstance(size, str):
             continue
-        separator = title.find(' - ')
-        price = title[:separator]
-        brand_end = separator + 3
-        while not title[brand_end].isspace():
-            brand_end += 1
-        brand = title[separator+3:brand_end].strip()
         size += 'GB@${} {}'.format(price, brand)
         # Add price as the first element of the tuple for sorting
-        descriptions.append((decimal.Decimal(price.replace(',', '')), size))
+        append((to_decimal(price), size))
 
     if len(descriptions) > 0:
         print('        Newegg:')
-        descriptions.sort()
+        descriptions.sort(key=operator.itemgetter(0))
         for price, description in descriptions:
             print('        -', description)
 
     return descriptions
 
-def _parse_document(document):
+def _parse_document(document, store_filter=None, type_filter=None):
     """Return a dictionary of Item instances parsed from document.
 
     Args:
         document: Dictionary containing price descriptions.
+        store_filter: Optional lowercase string name of the only store to
+            parse.
+        type_filter: Optional lowercase string type of the only memory
+            modules to parse.
     Returns:
         Dictionary mapping a datetime.date to a list of Item instances.
     """
     if not isinstance(document, dict):
         return {}
 
-    result = collections.defaultdict(list)
-    for date in document:
-        if not isinstance(date, datetime.date):
-            continue
-        if not isinstance(document[date], dict):
+    parse_description = _parse_description
+    unchecked = Item._unchecked
+
+    result = {}
+    for date, dimm_types in document.items():
+        # YAML loaders build exact dicts and lists, but keep isinstance for
+        # the date since datetime.datetime is a subclass of datetime.date
+        if not (isinstance(date, datetime.date) and
+                (type(dimm_types) is dict)):
             continue
-        for dimm_type in document[date]:
-            if not isinstance(document[date][dimm_type], dict):
+        items = []
+        append = items.append
+        for dimm_type, stores in dimm_types.items():
+            if type(stores) is not dict:
                 continue
-            for store in document[date][dimm_type]:
-                if not isinstance(document[date][dimm_type][store], list):
+            if ((type_filter is not None) and
+                (not isinstance(dimm_type, str) or
+                 (dimm_type.strip().lower() != type_filter))):
+                continue
+            for store, entries in stores.items():
+                if type(entries) is not list:
+                    continue
+                if ((store_filter is not None) and
+                    (not isinstance(store, str) or
+                     (store.strip().lower() != store_filter))):
                     continue
-                for entry in document[date][dimm_type][store]:
-                    count, size, price, brand = _parse_description(entry)
+                # Check the keys once here instead of once per Item
+                valid = (isinstance(dimm_type, str) and
+                         (len(dimm_type) >= 6) and
+                         isinstance(store, str) and
+                         (len(store) >= 5))
+                for entry in entries:
+                    count, size, price, brand = parse_description(entry)
                     if size > 0:
-                        try:
-                            result[date].append(
-                                Item(date, dimm_type, store, count,
-                                     size, price, brand))
-                        except ValueError:
+                        if valid and (count > 0) and (len(brand) >= 3):
+                            append(unchecked(date, dimm_type, store, count,
+                                             size, price, brand))
+                        else:
                             print('Invalid entry:', entry)
+        if len(items) > 0:
+            result[date] = items
     return result
 
 
@@ -314,7 +417,11 @@ class _UnitTest(unittest.TestCase):
             ('4x8GB@$48.99 Foo', (4, 8, decimal.Decimal('48.99'), 'Foo')),
             ('10x1GB@$101.99', (10, 0, decimal.Decimal(), '')),
             ('10x1GB@$101.99 ', (10, 1, decimal.Decimal('101.99'), '')),
-            ('10x1GB@$101.99 Foo', (10, 1, decimal.Decimal('101.99'), 'Foo'))]:
+            ('10x1GB@$101.99 Foo', (10, 1, decimal.Decimal('101.99'), 'Foo')),
+            ('8GB@$TBD Foobar', (1, 0, decimal.Decimal(), '')),
+            ('8GB@$. Foobar', (1, 0, decimal.Decimal(), '')),
+            ('8GB@$, Foobar', (1, 0, decimal.Decimal(), '')),
+            ('8GB@$1.2.3 Foobar', (1, 0, decimal.Decimal(), ''))]:
             self.assertEqual(_parse_description(value), expected)
 
     def test_parse_module_size(self):
@@ -323,6 +430,10 @@ class _UnitTest(unittest.TestCase):
             self.assertRaises(TypeError, _parse_module_size, value)
         for value in ['', 'foobar', 'foobarbaz']:
             self.assertIsNone(_parse_module_size(value))
+        # Gb chip densities and Gbps speeds are not module sizes
+        self.assertEqual(_parse_module_size('Foo 32GB DDR5 6000 16Gb A-die'),
+                         '32')
+        self.assertEqual(_parse_module_size('Foo 16GB 8Gbps'), '16')
         for value, expected in [
             (' 4GB', '4'),
             (' 4 GB', '4'),
@@ -409,6 +520,43 @@ class _UnitTest(unittest.TestCase):
        (decimal.Decimal('18.99'), '8GB@$18.99 Foobar'),
        (decimal.Decimal('24.99'), '2x4GB@$24.99 Foobar'),
        (decimal.Decimal('28.99'), '2x8GB@$28.99 Foobar')])
+        self.assertEqual(_parse_micro_center('''
+<div id="productImpressions" class="hidden">{
+'id': '1234',
+'price': '48.99',
+'brand': 'Foobar',
+'name': 'Foobar 32GB (2 x 16GB)'}, {
+'name': "Foobar's 8GB",
+'brand': 'Foo\\'s',
+'price': '38.99'}, {
+'name': 'Foobar 64GB (2 x 32GB)',
+'brand': 'Foobar'}, {
+'name': 'Foobar 64GB (2 x 32GB)',
+'brand': 'Foobar',
+'price': 'Call'}
+</div>
+'''), [(decimal.Decimal('38.99'), "8GB@$38.99 Foo's"),
+       (decimal.Decimal('48.99'), '2x16GB@$48.99 Foobar')])
+        self.assertEqual(_parse_micro_center('''
+<div id="productImpressions" class="hidden">{
+'name': 'Foobar 8GB {new}',
+'brand': 'Foobar',
+'price': '18.99'}, {
+'name': 'Foobar 16GB (2 x 8GB)',
+'category': {'name': 'Memory'},
+'brand': 'Foobar',
+'price': '28.99'}
+</div>
+'''), [(decimal.Decimal('18.99'), '8GB@$18.99 Foobar'),
+       (decimal.Decimal('28.99'), '2x8GB@$28.99 Foobar')])
+        self.assertEqual(_parse_micro_center('''
+<div id="productImpressions" class="hidden">{
+"name": "Foobar 8GB",
+"brand": "Foobar",
+"price": "18.99",
+"new": true}
+</div>
+'''), [(decimal.Decimal('18.99'), '8GB@$18.99 Foobar')])
 
     def test_parse_newegg(self):
         """Test parsing the Newegg feed."""
@@ -421,11 +569,18 @@ class _UnitTest(unittest.TestCase):
 <title>&#36;24.99 - Foobar 8GB (2 x 4GB)</title>
 <title>&#36;18.99 - Foobar 8GB</title>
 <title>&#36;28.99 - Foobar 16GB (2 x 8GB)</title>
+<title>&#36;Call - Foobar 32GB (2 x 16GB)</title>
+<title>&#36;, - Foobar 32GB (2 x 16GB)</title>
+<title>Foobar 64GB (2 x 32GB)</title>
 </rss>
 '''), [(decimal.Decimal('14.99'), '4GB@$14.99 Foobar'),
        (decimal.Decimal('18.99'), '8GB@$18.99 Foobar'),
        (decimal.Decimal('24.99'), '2x4GB@$24.99 Foobar'),
        (decimal.Decimal('28.99'), '2x8GB@$28.99 Foobar')])
+        self.assertEqual(_parse_newegg(
+            '<title>&#36;9.99 - Foobar</title>' +
+            '<title>&#36;19.99 - Baz 16GB (2 x 8GB)</title>'),
+            [(decimal.Decimal('19.99'), '2x8GB@$19.99 Baz')])
 
     def test_item(self):
         """Test the Item class."""
@@ -459,6 +614,13 @@ class _UnitTest(unittest.TestCase):
             self.assertRaises(
                 ValueError, Item, today, 'laptop', 'store', 1, value,
                 decimal.Decimal(), 'brand')
+        item = Item(today, ' Laptop', 'Store ', 2, 8,
+                    decimal.Decimal('28.99'), 'Brand')
+        self.assertEqual(str(item), '2x8GB@$28.99 brand for laptop from ' +
+                         'store on ' + today.isoformat())
+        self.assertEqual(item.total_size, 16)
+        # Item uses __slots__ so there is no per-instance dictionary
+        self.assertFalse(hasattr(item, '__dict__'))
 
     def test_parse_document(self):
         """Test parsing a YAML document."""
@@ -479,6 +641,23 @@ class _UnitTest(unittest.TestCase):
         self.assertEqual(len(result), 1)
         self.assertIn(today, result)
         self.assertEqual(len(result[today]), 2)
+        self.assertEqual(str(result[today][1]),
+                         '2x4GB@$24.99 foo for laptop from store on ' +
+                         today.isoformat())
+        result = _parse_document({
+            today: {
+                'desktop': {
+                    'store': ['4GB@$14.99 Foo'],
+                    'other store': ['8GB@$18.99 Foo']
+                },
+                'laptop': {
+                    'store': ['2x4GB@$24.99 Foo']
+                }
+            }
+        }, store_filter='store', type_filter='desktop')
+        self.assertEqual([str(item) for item in result[today]],
+                         ['1x4GB@$14.99 foo for desktop from store on ' +
+                          today.isoformat()])
 
 if __name__ == '__main__':
     import argparse
@@ -571,30 +750,38 @@ if __name__ == '__main__':
             print('        -', description)
     elif os.path.isfile(args.path):
         import yaml
-        date_map = {}
+        try:
+            # Prefer the libyaml bindings when available
+            from yaml import CSafeLoader as SafeLoader
+        except ImportError:
+            from yaml import SafeLoader
+        date_map = collections.defaultdict(list)
         with open(args.path, 'r', encoding='utf-8') as f:
-            for document in yaml.safe_load_all(f):
-                date_map.update(_parse_document(document))
+            for document in yaml.load_all(f.read(), Loader=SafeLoader):
+                for date, items in _parse_document(
+                        document, args.store.strip().lower() or None,
+                        args.type.strip().lower() or None).items():
+                    date_map[date].extend(items)
+        # Sum in the default context and round only the average
+        average_context = decimal.Context(prec=10)
         for date in sorted(date_map.keys()):
             items = date_map[date]
             if args.module > 0:
                 items = [item for item in items if item.size == args.module]
-            if len(args.store) > 0:
-                items = [item for item in items
-                         if item.store == args.store.strip().lower()]
-            if len(args.type) > 0:
-                items = [item for item in items
-                         if item.dimm_type == args.type.strip().lower()]
             if len(items) <= 0:
                 continue
             if args.module > 0:
+                total = sum((item.price / item.count for item in items),
+                            decimal.Decimal())
                 print('{}: Price/Module: ${}'.format(
-                    date.isoformat(), statistics.mean(
-                        [item.price / item.count for item in items])))
+                    date.isoformat(),
+                    average_context.divide(total, len(items))))
             else:
+                total = sum((item.price / item.total_size for item in items),
+                            decimal.Decimal())
                 print('{}: Price/GB: ${}'.format(
-                    date.isoformat(), statistics.mean(
-                        [item.price / item.total_size for item in items])))
+                    date.isoformat(),
+                    average_context.divide(total, len(items))))
     else:
         tests = [doctest.DocTestSuite(),
                  unittest.defaultTestLoader.loadTestsFromTestCase(_UnitTest)]